@@ -5,40 +5,90 @@ Enhanced camera streaming with controls, recording, gallery, and more.
 Compatible with Raspberry Pi 4B running Trixie with Camera V2.
 """
 
+import asyncio
+import functools
+import hashlib
 import io
 import os
 import json
 import logging
+import shutil
 import socket
+import struct
+import subprocess
 import threading
 import time
 import datetime
+from array import array
 from http.server import HTTPServer, BaseHTTPRequestHandler
 from socketserver import ThreadingMixIn
 from urllib.parse import urlparse, parse_qs
 from pathlib import Path
 
 try:
-    from picamera2 import Picamera2
-    from picamera2.encoders import H264Encoder
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+try:
+    from picamera2 import MappedArray, Picamera2
+    from picamera2.encoders import H264Encoder, MJPEGEncoder
     from picamera2.outputs import FileOutput
     PICAMERA_AVAILABLE = True
 except ImportError:
     PICAMERA_AVAILABLE = False
     print("⚠️  picamera2 not available - running in demo mode")
 
+try:
+    from turbojpeg import TurboJPEG, TJPF_BGR, TJSAMP_420, TJFLAG_FASTDCT
+    TURBOJPEG_AVAILABLE = NUMPY_AVAILABLE
+except ImportError:
+    TURBOJPEG_AVAILABLE = False
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
 # Configuration
 SERVER_PORT = 8080
 FRAME_WIDTH = 1280
 FRAME_HEIGHT = 720
 FRAME_RATE = 30
+STREAM_BITRATE = 10_000_000
+VIEWER_STALL_FRAMES = FRAME_RATE * 10  # drop viewers stuck for ~10 s
+MOTION_WIDTH = 320
+MOTION_HEIGHT = 240
+JPEG_QUALITY = 85
+IP_CACHE_TTL = 60  # seconds
+
+# ioctl request for an interface's IPv4 address (linux/sockios.h)
+SIOCGIFADDR = 0x8915
+
+# Constant parts of each MJPEG multipart frame
+MJPEG_FRAME_PREFIX = b'--FRAME\r\nContent-Type: image/jpeg\r\nContent-Length: '
+MJPEG_HEADER_END = b'\r\n\r\n'
+MJPEG_FRAME_END = b'\r\n'
 
 # Paths
 BASE_DIR = Path(__file__).parent
 STATIC_DIR = BASE_DIR / "static"
+STATIC_ROOT = STATIC_DIR.resolve()
 CAPTURES_DIR = BASE_DIR / "captures"
 CAPTURES_DIR.mkdir(exist_ok=True)
 
+# Recordings are remuxed to MP4 when ffmpeg is installed
+FFMPEG_PATH = shutil.which("ffmpeg")
+
+# Gallery file types
+GALLERY_EXTENSIONS = frozenset({'.jpg', '.jpeg', '.png', '.h264', '.mp4'})
+IMAGE_EXTENSIONS = frozenset({'.jpg', '.jpeg', '.png'})
+
+# Static file cache: resolved path -> (content, etag), filled on first request
+STATIC_CACHE = {}
+
 # Logging
 logging.basicConfig(
     level=logging.INFO,
@@ -47,17 +97,121 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
+def json_bytes(data):
+    """Encode data as a JSON response body, using orjson when installed."""
+    if ORJSON_AVAILABLE:
+        try:
+            return orjson.dumps(data, option=orjson.OPT_APPEND_NEWLINE)
+        except orjson.JSONEncodeError:
+            # e.g. integers beyond 64 bits, which json handles
+            pass
+    return json.dumps(data).encode('utf-8') + b'\n'
+
+
+def capture_path(filename):
+    """Get the path of a file in CAPTURES_DIR, or None if it escapes it."""
+    filepath = CAPTURES_DIR / filename
+    try:
+        # Resolving catches '..' components and symlinks pointing outside
+        filepath.resolve().relative_to(CAPTURES_DIR.resolve())
+    except ValueError:
+        return None
+    return filepath if filepath.is_file() else None
+
+
+def parse_byte_range(header, size):
+    """Parse a single-range 'bytes=' header into inclusive (start, end).
+
+    Returns None for headers we don't handle (serve the whole file) and
+    raises ValueError when the range is not satisfiable.
+    """
+    unit, _, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in spec:
+        return None
+    first, _, last = spec.strip().partition('-')
+    try:
+        if first:
+            start = int(first)
+            end = int(last) if last else size - 1
+            if last and end < start:
+                return None  # malformed, so the header is ignored
+        else:
+            start = size - int(last)  # suffix range: the last N bytes
+            end = size - 1
+    except ValueError:
+        return None
+    start = max(start, 0)
+    end = min(end, size - 1)
+    if start > end:
+        raise ValueError(f"Unsatisfiable range: {header}")
+    return start, end
+
+
+def make_test_pattern(frame, t):
+    """Fill a BGR frame with a moving test pattern (demo mode)."""
+    height, width, _ = frame.shape
+    x = np.arange(width)
+    y = np.arange(height)[:, None]
+    frame[..., 0] = (x + t) & 0xFF
+    frame[..., 1] = (y + t) & 0xFF
+    frame[..., 2] = (x ^ y) & 0xFF
+
+
+@functools.lru_cache(maxsize=1)
+def get_test_pattern():
+    """Get the test pattern function, JIT-compiled when numba is installed.
+
+    numba is heavy to import, so this only happens once demo mode needs it.
+    """
+    try:
+        from numba import njit, prange
+    except ImportError:
+        return make_test_pattern
+    
+    @njit(parallel=True, fastmath=True, cache=True)
+    def make_test_pattern_jit(frame, t):
+        height, width, _ = frame.shape
+        for y in prange(height):
+            for x in range(width):
+                frame[y, x, 0] = (x + t) & 0xFF
+                frame[y, x, 1] = (y + t) & 0xFF
+                frame[y, x, 2] = (x ^ y) & 0xFF
+    
+    return make_test_pattern_jit
+
+
 class CameraController:
     """Manages camera settings and operations."""
     
-    def __init__(self):
+    def __init__(self, output):
         self.picam2 = None
+        self.output = output
+        self.still_config = None
         self.is_recording = False
         self.recording_file = None
         self.encoder = None
+        self.stream_encoder = None
+        self.ffmpeg = None
+        self.motion = 0.0
+        self._last_luma = None
         self.start_time = time.time()
-        self.frame_count = 0
+        self._uptime_seconds = -1
+        self._uptime = None
         self.viewers = 0
+        self.jpeg = None
+        self._settings_lock = threading.Lock()
+        self._settings_json = None
+        
+        # Gallery index as columns (oldest first), kept in step with
+        # snapshot/record/delete
+        self._gallery_lock = threading.Lock()
+        self._rows = {}  # name -> index into the columns
+        self._names = []
+        self._types = []
+        self._sizes = array('Q')
+        self._ctimes = array('d')
+        self._gallery_json = None
+        self._scan_gallery()
         
         # Camera settings with defaults
         self.settings = {
@@ -78,21 +232,62 @@ class CameraController:
         
         if PICAMERA_AVAILABLE:
             self._init_camera()
+        # Demo mode also covers picamera2 being installed without a camera
+        if self.picam2 is None and TURBOJPEG_AVAILABLE:
+            self._init_jpeg()
     
     def _init_camera(self):
         """Initialize the camera."""
         try:
             self.picam2 = Picamera2()
-            config = self.picam2.create_still_configuration(
-                main={"size": (FRAME_WIDTH, FRAME_HEIGHT)}
+            config = self.picam2.create_video_configuration(
+                main={"size": (FRAME_WIDTH, FRAME_HEIGHT), "format": "YUV420"},
+                lores={"size": (MOTION_WIDTH, MOTION_HEIGHT), "format": "YUV420"},
+                controls={"FrameRate": FRAME_RATE}
             )
+            self.still_config = self.picam2.create_still_configuration()
             self.picam2.configure(config)
-            self.picam2.start()
+            self.picam2.post_callback = self._measure_motion
+            # The hardware MJPEG encoder feeds the stream buffer directly
+            self.stream_encoder = MJPEGEncoder(bitrate=STREAM_BITRATE)
+            self.picam2.start_recording(
+                self.stream_encoder, FileOutput(self.output)
+            )
             logger.info("Camera initialized successfully")
         except Exception as e:
             logger.error(f"Failed to initialize camera: {e}")
             self.picam2 = None
     
+    def _measure_motion(self, request):
+        """Track frame-to-frame change on the ISP's small luma plane."""
+        # Still captures from switch_mode_and_capture_file have no lores stream
+        if request.config.get("lores") is None:
+            return
+        with MappedArray(request, "lores", write=False) as m:
+            luma = m.array[:MOTION_HEIGHT, :MOTION_WIDTH].astype(np.int16)
+        if self._last_luma is not None:
+            self.motion = float(np.abs(luma - self._last_luma).mean())
+        self._last_luma = luma
+    
+    def motion_magnitude(self):
+        """Mean absolute luma change between the last two frames (0-255)."""
+        return self.motion
+    
+    def _init_jpeg(self):
+        """Load libjpeg-turbo for software JPEG encoding."""
+        try:
+            self.jpeg = TurboJPEG()
+        except Exception as e:
+            logger.warning(f"libjpeg-turbo not available: {e}")
+            self.jpeg = None
+    
+    def encode_jpeg(self, frame):
+        """Software-encode a BGR frame, matching the hardware stream's 4:2:0."""
+        return self.jpeg.encode(
+            frame, quality=JPEG_QUALITY, pixel_format=TJPF_BGR,
+            jpeg_subsample=TJSAMP_420, flags=TJFLAG_FASTDCT
+        )
+    
     def get_settings(self):
         """Get current camera settings."""
         return {
@@ -102,11 +297,20 @@ class CameraController:
             "is_recording": self.is_recording
         }
     
+    def get_settings_json(self):
+        """Get the settings as encoded JSON, cached until they change."""
+        with self._settings_lock:
+            if self._settings_json is None:
+                self._settings_json = json_bytes(self.get_settings())
+            return self._settings_json
+    
     def update_settings(self, new_settings):
         """Update camera settings."""
-        for key, value in new_settings.items():
-            if key in self.settings:
-                self.settings[key] = value
+        with self._settings_lock:
+            for key, value in new_settings.items():
+                if key in self.settings:
+                    self.settings[key] = value
+            self._settings_json = None
         
         if self.picam2 and PICAMERA_AVAILABLE:
             try:
@@ -127,22 +331,55 @@ class CameraController:
         
         return self.settings
     
-    def capture_snapshot(self):
-        """Capture and save a snapshot."""
+    def capture_snapshot(self, hires=False):
+        """Save a snapshot: the latest stream frame, or a full-res still."""
         timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
         filename = f"snapshot_{timestamp}.jpg"
         filepath = CAPTURES_DIR / filename
         
+        frame = self.output.frame
+        if frame and not hires:
+            # The stream already holds a fresh JPEG - no new capture needed
+            try:
+                filepath.write_bytes(frame)
+                self._add_to_gallery(filename)
+                logger.info(f"Snapshot saved: {filename}")
+                return {"success": True, "filename": filename}
+            except OSError as e:
+                logger.error(f"Snapshot failed: {e}")
+                return {"success": False, "error": str(e)}
+        
         if self.picam2 and PICAMERA_AVAILABLE:
+            if self.is_recording:
+                return {"success": False, "error": "Hi-res snapshots are unavailable while recording"}
             try:
-                self.picam2.capture_file(str(filepath))
+                # Full-sensor still mode; the stream pauses briefly. The
+                # MJPEG encoder is sized for the video mode, so it must not
+                # see the still buffers.
+                self.picam2.stop_encoder(self.stream_encoder)
+                try:
+                    self.picam2.switch_mode_and_capture_file(
+                        self.still_config, str(filepath)
+                    )
+                finally:
+                    self.picam2.start_encoder(
+                        self.stream_encoder, FileOutput(self.output)
+                    )
+                self._add_to_gallery(filename)
                 logger.info(f"Snapshot saved: {filename}")
                 return {"success": True, "filename": filename}
             except Exception as e:
                 logger.error(f"Snapshot failed: {e}")
                 return {"success": False, "error": str(e)}
+        elif self.jpeg:
+            # Demo mode - save an encoded test pattern
+            frame = np.empty((FRAME_HEIGHT, FRAME_WIDTH, 3), dtype=np.uint8)
+            get_test_pattern()(frame, int(time.time() * FRAME_RATE))
+            filepath.write_bytes(self.encode_jpeg(frame))
+            self._add_to_gallery(filename)
+            logger.info(f"Snapshot saved: {filename}")
+            return {"success": True, "filename": filename}
         else:
-            # Demo mode - create placeholder
             return {"success": False, "error": "Camera not available"}
     
     def start_recording(self):
@@ -151,19 +388,40 @@ class CameraController:
             return {"success": False, "error": "Already recording"}
         
         timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"recording_{timestamp}.h264"
+        filename = f"recording_{timestamp}.{'mp4' if FFMPEG_PATH else 'h264'}"
         filepath = CAPTURES_DIR / filename
         
         if self.picam2 and PICAMERA_AVAILABLE:
             try:
+                if FFMPEG_PATH:
+                    # Mux the hardware H.264 stream into MP4 without re-encoding
+                    self.ffmpeg = subprocess.Popen(
+                        [FFMPEG_PATH, '-y', '-f', 'h264', '-framerate', str(FRAME_RATE),
+                         '-i', 'pipe:0', '-c:v', 'copy',
+                         '-movflags', '+frag_keyframe+empty_moov', '-f', 'mp4',
+                         str(filepath)],
+                        stdin=subprocess.PIPE,
+                        stdout=subprocess.DEVNULL,
+                        stderr=subprocess.DEVNULL
+                    )
+                    recording_output = FileOutput(self.ffmpeg.stdin)
+                else:
+                    recording_output = FileOutput(str(filepath))
+                
+                # Second encoder on the same stream, so streaming continues.
+                # Both encoders are handed the same ISP buffer for each
+                # frame, so nothing is copied or encoded twice in Python.
                 self.encoder = H264Encoder()
-                self.picam2.start_recording(self.encoder, str(filepath))
-                self.is_recording = True
+                self.picam2.start_encoder(self.encoder, recording_output)
+                with self._settings_lock:
+                    self.is_recording = True
+                    self._settings_json = None
                 self.recording_file = filename
                 logger.info(f"Recording started: {filename}")
                 return {"success": True, "filename": filename}
             except Exception as e:
                 logger.error(f"Recording failed: {e}")
+                self._close_ffmpeg()
                 return {"success": False, "error": str(e)}
         return {"success": False, "error": "Camera not available"}
     
@@ -174,10 +432,18 @@ class CameraController:
         
         if self.picam2 and PICAMERA_AVAILABLE:
             try:
-                self.picam2.stop_recording()
-                self.is_recording = False
+                self.picam2.stop_encoder(self.encoder)
+                self.encoder = None
+                muxed = self._close_ffmpeg()
+                with self._settings_lock:
+                    self.is_recording = False
+                    self._settings_json = None
                 filename = self.recording_file
                 self.recording_file = None
+                self._add_to_gallery(filename)
+                if not muxed:
+                    return {"success": False, "filename": filename,
+                            "error": "ffmpeg failed to finish the recording"}
                 logger.info(f"Recording stopped: {filename}")
                 return {"success": True, "filename": filename}
             except Exception as e:
@@ -185,41 +451,109 @@ class CameraController:
                 return {"success": False, "error": str(e)}
         return {"success": False, "error": "Camera not available"}
     
-    def get_gallery(self):
-        """Get list of captured files."""
-        files = []
-        for f in CAPTURES_DIR.iterdir():
-            if f.suffix.lower() in ['.jpg', '.jpeg', '.png', '.h264', '.mp4']:
-                stat = f.stat()
-                files.append({
-                    "name": f.name,
-                    "type": "image" if f.suffix.lower() in ['.jpg', '.jpeg', '.png'] else "video",
-                    "size": stat.st_size,
-                    "created": datetime.datetime.fromtimestamp(stat.st_ctime).isoformat()
+    def _close_ffmpeg(self):
+        """Let ffmpeg finish writing the MP4 and exit; False if it failed."""
+        if not self.ffmpeg:
+            return True
+        ffmpeg, self.ffmpeg = self.ffmpeg, None
+        try:
+            ffmpeg.stdin.close()
+        except OSError:
+            pass  # ffmpeg already exited; its return code says why
+        try:
+            ffmpeg.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            logger.error("ffmpeg did not exit, killing it")
+            ffmpeg.kill()
+            ffmpeg.wait()
+        if ffmpeg.returncode != 0:
+            logger.error(f"ffmpeg exited with code {ffmpeg.returncode}")
+            return False
+        return True
+    
+    def _scan_gallery(self):
+        """Build the gallery index from the captures directory."""
+        found = []
+        with os.scandir(CAPTURES_DIR) as entries:
+            for entry in entries:
+                suffix = os.path.splitext(entry.name)[1].lower()
+                if suffix in GALLERY_EXTENSIONS and entry.is_file():
+                    stat = entry.stat()
+                    found.append((stat.st_ctime, entry.name, stat))
+        for _, filename, stat in sorted(found):
+            self._add_to_gallery(filename, stat)
+    
+    def _add_to_gallery(self, filename, stat=None):
+        """Add or refresh one file in the gallery index."""
+        if stat is None:
+            stat = os.stat(CAPTURES_DIR / filename)
+        suffix = os.path.splitext(filename)[1].lower()
+        
+        with self._gallery_lock:
+            i = self._rows.get(filename)
+            if i is not None:
+                self._sizes[i] = stat.st_size
+                self._ctimes[i] = stat.st_ctime
+            else:
+                self._rows[filename] = len(self._names)
+                self._names.append(filename)
+                self._types.append("image" if suffix in IMAGE_EXTENSIONS else "video")
+                self._sizes.append(stat.st_size)
+                self._ctimes.append(stat.st_ctime)
+            self._gallery_json = None
+    
+    def _remove_from_gallery(self, filename):
+        """Drop one file from the gallery index."""
+        with self._gallery_lock:
+            i = self._rows.pop(filename, None)
+            if i is None:
+                return
+            del self._names[i], self._types[i], self._sizes[i], self._ctimes[i]
+            # Later rows moved up by one
+            for j in range(i, len(self._names)):
+                self._rows[self._names[j]] = j
+            self._gallery_json = None
+    
+    def get_gallery_json(self):
+        """Get captured files as JSON columns, oldest first, cached until changed."""
+        # Built under the lock so a body from before a change is never stored
+        with self._gallery_lock:
+            if self._gallery_json is None:
+                self._gallery_json = json_bytes({
+                    "names": self._names,
+                    "types": self._types,
+                    "sizes": self._sizes.tolist(),
+                    "created": self._ctimes.tolist()
                 })
-        return sorted(files, key=lambda x: x["created"], reverse=True)
+            return self._gallery_json
     
     def delete_file(self, filename):
         """Delete a captured file."""
-        filepath = CAPTURES_DIR / filename
-        if filepath.exists() and filepath.parent == CAPTURES_DIR:
+        filepath = capture_path(filename)
+        if filepath:
             filepath.unlink()
+            self._remove_from_gallery(filename)
             return {"success": True}
         return {"success": False, "error": "File not found"}
     
     def get_stats(self):
         """Get server statistics."""
         uptime = int(time.time() - self.start_time)
-        hours, remainder = divmod(uptime, 3600)
-        minutes, seconds = divmod(remainder, 60)
+        if uptime != self._uptime_seconds:
+            # Format at most once per second, however often stats are polled
+            hours, remainder = divmod(uptime, 3600)
+            minutes, seconds = divmod(remainder, 60)
+            self._uptime = f"{hours:02d}:{minutes:02d}:{seconds:02d}"
+            self._uptime_seconds = uptime
         
         return {
-            "uptime": f"{hours:02d}:{minutes:02d}:{seconds:02d}",
+            "uptime": self._uptime,
             "uptime_seconds": uptime,
-            "frame_count": self.frame_count,
+            "frame_count": self.output.frame_count,
             "viewers": self.viewers,
             "is_recording": self.is_recording,
-            "captures_count": len(list(CAPTURES_DIR.iterdir())),
+            "captures_count": len(self._names),
+            "motion": round(self.motion_magnitude(), 2),
             "camera_available": self.picam2 is not None
         }
     
@@ -228,53 +562,147 @@ class CameraController:
         if self.is_recording:
             self.stop_recording()
         if self.picam2:
-            self.picam2.stop()
+            self.picam2.stop_recording()
             self.picam2.close()
 
 
-class StreamingOutput:
+class MJPEGViewer(asyncio.Protocol):
+    """One MJPEG client connection owned by the broadcaster's event loop."""
+
+    def __init__(self, broadcaster):
+        self.broadcaster = broadcaster
+        self.transport = None
+        self.skipped = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.broadcaster.viewers.add(self)
+        camera.viewers += 1
+
+    def connection_lost(self, exc):
+        self.broadcaster.viewers.discard(self)
+        camera.viewers -= 1
+
+    def data_received(self, data):
+        pass  # Nothing to read once streaming has started
+
+
+class StreamBroadcaster:
+    """Fans MJPEG frames out to every viewer from a single asyncio loop.
+
+    Viewers don't each hold a server thread: the HTTP handler sends the
+    response headers and then hands its socket to this loop.
+    """
+
+    def __init__(self):
+        self.viewers = set()
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+
+    def start(self):
+        """Run the event loop in a background thread."""
+        self.thread.start()
+
+    def add_viewer(self, sock):
+        """Take over an accepted connection (called from a handler thread)."""
+        asyncio.run_coroutine_threadsafe(
+            self.loop.connect_accepted_socket(lambda: MJPEGViewer(self), sock),
+            self.loop
+        )
+
+    def publish(self, frame):
+        """Queue a frame for all viewers (called from the encoder thread)."""
+        if self.viewers:
+            self.loop.call_soon_threadsafe(self._broadcast, frame)
+
+    def _broadcast(self, frame):
+        # Gathered write per viewer; the frame itself is never copied
+        parts = [MJPEG_FRAME_PREFIX, str(len(frame)).encode(),
+                 MJPEG_HEADER_END, frame, MJPEG_FRAME_END]
+        for viewer in self.viewers:
+            transport = viewer.transport
+            if transport.is_closing():
+                continue
+            if transport.get_write_buffer_size() > len(frame):
+                # Still sending an earlier frame: skip this one so a slow
+                # viewer gets fewer frames instead of an ever-growing buffer
+                viewer.skipped += 1
+                if viewer.skipped > VIEWER_STALL_FRAMES:
+                    transport.abort()
+                continue
+            viewer.skipped = 0
+            transport.writelines(parts)
+
+
+class StreamingOutput(io.BufferedIOBase):
     """Thread-safe output buffer for camera frames."""
     
-    def __init__(self):
-        self.frame = None
-        self.condition = threading.Condition()
+    def __init__(self, broadcaster):
+        self.broadcaster = broadcaster
+        # (sequence number, JPEG bytes), replaced as a single attribute store
+        self.latest = (0, None)
+        self.event = threading.Event()
+
+    @property
+    def frame(self):
+        return self.latest[1]
+
+    @property
+    def frame_count(self):
+        return self.latest[0]
+
+    def write(self, buf):
+        """Receives one complete JPEG from the MJPEG encoder."""
+        self.update_frame(bytes(buf))
+        return len(buf)
 
     def update_frame(self, buf):
         """Updates the current frame and notifies listeners."""
-        with self.condition:
-            self.frame = buf
-            self.condition.notify_all()
+        # Attribute stores are atomic under the GIL, so readers need no lock
+        self.latest = (self.latest[0] + 1, buf)
+        self.event.set()
+        self.event.clear()
+        self.broadcaster.publish(buf)
+
+    def wait_for_frame(self, last_seq, timeout=5.0):
+        """Waits for a frame newer than last_seq; returns (seq, frame)."""
+        seq, frame = self.latest
+        if seq == last_seq:
+            self.event.wait(timeout)
+            seq, frame = self.latest
+        return seq, frame
 
 
 # Global instances
-camera = CameraController()
-output = StreamingOutput()
+streamer = StreamBroadcaster()
+output = StreamingOutput(streamer)
+camera = CameraController(output)
 
 
-def capture_loop():
-    """Continuously captures complete JPEG frames."""
-    logger.info("Starting capture loop...")
-    stream = io.BytesIO()
+def demo_loop():
+    """Streams an encoded test pattern when no camera is available."""
+    logger.info("Starting demo pattern loop...")
+    frame = np.empty((FRAME_HEIGHT, FRAME_WIDTH, 3), dtype=np.uint8)
+    fill_pattern = get_test_pattern()
+    t = 0
     
     while True:
         try:
-            if camera.picam2 and PICAMERA_AVAILABLE:
-                stream.seek(0)
-                stream.truncate()
-                camera.picam2.capture_file(stream, format='jpeg')
-                output.update_frame(stream.getvalue())
-                camera.frame_count += 1
-            else:
-                # Demo mode - just sleep
-                time.sleep(0.1)
+            fill_pattern(frame, t)
+            output.update_frame(camera.encode_jpeg(frame))
+            t += 1
         except Exception as e:
-            logger.error(f"Capture error: {e}")
-            time.sleep(1)
+            logger.error(f"Demo frame error: {e}")
+        time.sleep(1 / FRAME_RATE)
 
 
 class AdvancedCameraHandler(BaseHTTPRequestHandler):
     """HTTP request handler for advanced camera server."""
 
+    # Set TCP_NODELAY and buffer wfile so headers and body go out together
+    disable_nagle_algorithm = True
+    wbufsize = 65536
+
     def log_message(self, format, *args):
         pass  # Reduce log spam
 
@@ -296,11 +724,11 @@ class AdvancedCameraHandler(BaseHTTPRequestHandler):
         
         # API endpoints
         elif path == '/api/controls':
-            self.send_json(camera.get_settings())
+            self.send_json_content(camera.get_settings_json())
         elif path == '/api/stats':
             self.send_json(camera.get_stats())
         elif path == '/api/gallery':
-            self.send_json(camera.get_gallery())
+            self.send_json_content(camera.get_gallery_json())
         elif path.startswith('/api/gallery/'):
             filename = path.split('/')[-1]
             self.serve_capture(filename)
@@ -325,7 +753,8 @@ class AdvancedCameraHandler(BaseHTTPRequestHandler):
             result = camera.update_settings(data)
             self.send_json(result)
         elif path == '/api/snapshot':
-            result = camera.capture_snapshot()
+            hires = isinstance(data, dict) and bool(data.get('hires'))
+            result = camera.capture_snapshot(hires=hires)
             self.send_json(result)
         elif path == '/api/recording/start':
             result = camera.start_recording()
@@ -352,34 +781,82 @@ class AdvancedCameraHandler(BaseHTTPRequestHandler):
         # Handle both relative and absolute paths
         if filepath.startswith('/'):
             filepath = filepath[1:]
-        full_path = STATIC_DIR / filepath
-        if full_path.exists():
+        # Key the cache on the real file so aliases share one entry
+        full_path = (STATIC_DIR / filepath).resolve()
+        cached = STATIC_CACHE.get(full_path)
+        if cached is None:
+            try:
+                full_path.relative_to(STATIC_ROOT)
+            except ValueError:
+                full_path = None
+            if full_path is None or not full_path.is_file():
+                self.send_error(404, 'File not found')
+                return
             content = full_path.read_bytes()
-            self.send_response(200)
-            self.send_header('Content-Type', content_type)
-            self.send_header('Content-Length', len(content))
+            etag = f'"{hashlib.blake2b(content, digest_size=8).hexdigest()}"'
+            cached = STATIC_CACHE[full_path] = (content, etag)
+        
+        content, etag = cached
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
             self.end_headers()
-            self.wfile.write(content)
-        else:
-            self.send_error(404, 'File not found')
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', len(content))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(content)
 
     def serve_capture(self, filename):
         """Serve a captured file."""
-        filepath = CAPTURES_DIR / filename
-        if filepath.exists() and filepath.parent == CAPTURES_DIR:
-            content = filepath.read_bytes()
-            content_type = 'image/jpeg' if filename.endswith('.jpg') else 'video/mp4'
-            self.send_response(200)
+        filepath = capture_path(filename)
+        if not filepath:
+            self.send_error(404, 'File not found')
+            return
+        
+        content_type = 'image/jpeg' if filename.endswith('.jpg') else 'video/mp4'
+        with open(filepath, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            start, end = 0, size - 1
+            byte_range = None
+            
+            # Byte ranges let the browser seek in videos without downloading them
+            if self.headers.get('Range'):
+                try:
+                    byte_range = parse_byte_range(self.headers['Range'], size)
+                except ValueError:
+                    self.send_response(416)
+                    self.send_header('Content-Range', f'bytes */{size}')
+                    self.send_header('Content-Length', 0)
+                    self.end_headers()
+                    return
+            
+            if byte_range:
+                start, end = byte_range
+                self.send_response(206)
+                self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+            else:
+                self.send_response(200)
             self.send_header('Content-Type', content_type)
-            self.send_header('Content-Length', len(content))
+            self.send_header('Content-Length', end - start + 1)
+            self.send_header('Accept-Ranges', 'bytes')
             self.end_headers()
-            self.wfile.write(content)
-        else:
-            self.send_error(404, 'File not found')
+            self.wfile.flush()
+            if end >= start:
+                # Let the kernel copy the file straight to the socket
+                try:
+                    self.connection.sendfile(f, start, end - start + 1)
+                except (BrokenPipeError, ConnectionResetError, ConnectionAbortedError):
+                    pass  # Client disconnected (e.g. seeking in a video)
 
     def send_json(self, data):
         """Send JSON response."""
-        content = json.dumps(data).encode('utf-8')
+        self.send_json_content(json_bytes(data))
+
+    def send_json_content(self, content):
+        """Send an already encoded JSON response."""
         self.send_response(200)
         self.send_header('Content-Type', 'application/json')
         self.send_header('Content-Length', len(content))
@@ -389,39 +866,20 @@ class AdvancedCameraHandler(BaseHTTPRequestHandler):
 
     def send_mjpeg_stream(self):
         """Stream MJPEG video."""
-        camera.viewers += 1
         self.send_response(200)
         self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=FRAME')
         self.send_header('Cache-Control', 'no-cache, private')
         self.send_header('Pragma', 'no-cache')
         self.end_headers()
+        self.wfile.flush()
 
-        try:
-            while True:
-                with output.condition:
-                    if not output.condition.wait(timeout=5.0):
-                        continue
-                    frame = output.frame
-                
-                if frame:
-                    self.wfile.write(b'--FRAME\r\n')
-                    self.wfile.write(b'Content-Type: image/jpeg\r\n')
-                    self.wfile.write(f'Content-Length: {len(frame)}\r\n\r\n'.encode())
-                    self.wfile.write(frame)
-                    self.wfile.write(b'\r\n')
-                    self.wfile.flush()
-        except (BrokenPipeError, ConnectionResetError, ConnectionAbortedError):
-            pass
-        except Exception as e:
-            logger.debug(f"Stream ended: {e}")
-        finally:
-            camera.viewers -= 1
+        # Frames are written by the broadcaster; free this thread
+        self.close_connection = True
+        streamer.add_viewer(socket.socket(fileno=self.connection.detach()))
 
     def send_snapshot(self):
         """Send current frame as snapshot."""
-        with output.condition:
-            output.condition.wait(timeout=5.0)
-            frame = output.frame
+        _, frame = output.wait_for_frame(output.latest[0])
         
         if frame:
             self.send_response(200)
@@ -439,27 +897,29 @@ class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
     daemon_threads = True
 
 
-def get_ip_address():
-    """Get the IP address of this device."""
+def get_interface_address(sock, iface):
+    """Get the IPv4 address of a network interface, or None."""
+    try:
+        import fcntl  # Unix only; callers fall back to another lookup
+        request = struct.pack('256s', iface.encode()[:15])
+        packed = fcntl.ioctl(sock.fileno(), SIOCGIFADDR, request)
+    except (ImportError, OSError):
+        return None
+    return socket.inet_ntoa(packed[20:24])
+
+
+@functools.lru_cache(maxsize=1)
+def lookup_ip_address(ttl_bucket):
+    """Resolve the device IP; ttl_bucket changes to expire the cache."""
     try:
-        import netifaces
         preferred = ['wlan0', 'eth0', 'en0', 'wlan1']
-        interfaces = netifaces.interfaces()
+        interfaces = [name for _, name in socket.if_nameindex()]
+        ordered = [i for i in preferred if i in interfaces]
+        ordered += [i for i in interfaces if i not in ordered and i != 'lo']
         
-        for iface in preferred:
-            if iface in interfaces:
-                addrs = netifaces.ifaddresses(iface)
-                if netifaces.AF_INET in addrs:
-                    ip = addrs[netifaces.AF_INET][0].get('addr')
-                    if ip and not ip.startswith('127.'):
-                        return ip
-        
-        for iface in interfaces:
-            if iface == 'lo':
-                continue
-            addrs = netifaces.ifaddresses(iface)
-            if netifaces.AF_INET in addrs:
-                ip = addrs[netifaces.AF_INET][0].get('addr')
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            for iface in ordered:
+                ip = get_interface_address(s, iface)
                 if ip and not ip.startswith('127.'):
                     return ip
     except:
@@ -476,12 +936,19 @@ def get_ip_address():
         return "localhost"
 
 
+def get_ip_address():
+    """Get the IP address of this device."""
+    return lookup_ip_address(int(time.monotonic() // IP_CACHE_TTL))
+
+
 def main():
     logger.info("Starting Advanced Camera Server...")
+    streamer.start()
     
-    # Start capture thread
-    capture_thread = threading.Thread(target=capture_loop, daemon=True)
-    capture_thread.start()
+    # Demo mode - feed the stream with a generated test pattern
+    if camera.picam2 is None and camera.jpeg:
+        demo_thread = threading.Thread(target=demo_loop, daemon=True)
+        demo_thread.start()
     
     ip_address = get_ip_address()
     
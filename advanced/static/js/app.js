@@ -533,7 +533,14 @@ class AdvancedCameraApp {
     async loadGallery() {
         try {
             const response = await fetch('/api/gallery');
-            this.gallery = await response.json();
+            const columns = await response.json();
+            // Columnar payload, oldest first; keep newest first locally
+            this.gallery = columns.names.map((name, i) => ({
+                name,
+                type: columns.types[i],
+                size: columns.sizes[i],
+                created: columns.created[i]
+            })).reverse();
             this.renderGalleryPreview();
         } catch (error) {
             console.error('Gallery load error:', error);
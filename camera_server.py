@@ -5,20 +5,35 @@ Streams camera feed over WiFi for viewing in a web browser.
 Compatible with Raspberry Pi 4B running Trixie with Camera V2.
 """
 
+import functools
 import io
 import logging
+import queue
 import socket
+import struct
 import threading
 import time
 from http.server import HTTPServer, BaseHTTPRequestHandler
 from socketserver import ThreadingMixIn
 from picamera2 import Picamera2
+from picamera2.encoders import MJPEGEncoder
+from picamera2.outputs import FileOutput
 
 # Configuration
 SERVER_PORT = 8080
 FRAME_WIDTH = 1280
 FRAME_HEIGHT = 720
 FRAME_RATE = 30
+STREAM_BITRATE = 10_000_000
+IP_CACHE_TTL = 60  # seconds
+
+# ioctl request for an interface's IPv4 address (linux/sockios.h)
+SIOCGIFADDR = 0x8915
+
+# Constant parts of each MJPEG multipart frame
+MJPEG_FRAME_PREFIX = b'--FRAME\r\nContent-Type: image/jpeg\r\nContent-Length: '
+MJPEG_HEADER_END = b'\r\n\r\n'
+MJPEG_FRAME_END = b'\r\n'
 
 # Set up logging
 logging.basicConfig(
@@ -31,55 +46,79 @@ logger = logging.getLogger(__name__)
 picam2 = None
 
 
-class StreamingOutput:
+class Viewer:
+    """Per-client frame queue, so one slow client can't hold up the others."""
+
+    def __init__(self):
+        self.frames = queue.Queue(maxsize=2)
+
+
+class StreamingOutput(io.BufferedIOBase):
     """Thread-safe output buffer for camera frames."""
     
     def __init__(self):
-        self.frame = None
-        self.condition = threading.Condition()
+        # (sequence number, JPEG bytes), replaced as a single attribute store
+        self.latest = (0, None)
+        self.event = threading.Event()
+        self.viewers = set()
+
+    @property
+    def frame(self):
+        return self.latest[1]
+
+    def write(self, buf):
+        """Receives one complete JPEG from the MJPEG encoder."""
+        self.update_frame(bytes(buf))
+        return len(buf)
 
     def update_frame(self, buf):
         """Updates the current frame and notifies listeners."""
-        with self.condition:
-            self.frame = buf
-            self.condition.notify_all()
+        # Attribute stores are atomic under the GIL, so readers need no lock
+        self.latest = (self.latest[0] + 1, buf)
+        self.event.set()
+        self.event.clear()
+        
+        for viewer in tuple(self.viewers):
+            try:
+                viewer.frames.put_nowait(buf)
+            except queue.Full:
+                # Client is behind: replace its oldest frame with this one
+                try:
+                    viewer.frames.get_nowait()
+                except queue.Empty:
+                    pass
+                viewer.frames.put_nowait(buf)
+
+    def add_viewer(self):
+        """Registers a streaming client and returns its Viewer."""
+        viewer = Viewer()
+        self.viewers.add(viewer)
+        return viewer
+
+    def remove_viewer(self, viewer):
+        """Unregisters a streaming client."""
+        self.viewers.discard(viewer)
+
+    def wait_for_frame(self, last_seq, timeout=5.0):
+        """Waits for a frame newer than last_seq; returns (seq, frame)."""
+        seq, frame = self.latest
+        if seq == last_seq:
+            self.event.wait(timeout)
+            seq, frame = self.latest
+        return seq, frame
 
 
 # Create global output buffer
 output = StreamingOutput()
 
 
-def capture_loop():
-    """
-    Continuously captures complete JPEG frames.
-    This runs in a background thread.
-    """
-    global picam2
-    logger.info("Starting capture loop...")
-    
-    # Pre-allocate a stream to reduce memory churn
-    stream = io.BytesIO()
-    
-    while True:
-        try:
-            # Clear the stream for the new frame
-            stream.seek(0)
-            stream.truncate()
-            
-            # Capture one complete JPEG image
-            picam2.capture_file(stream, format='jpeg')
-            
-            # Update the shared buffer with the complete image data
-            output.update_frame(stream.getvalue())
-            
-        except Exception as e:
-            logger.error(f"Capture error: {e}")
-            time.sleep(1)
-
-
 class CameraHandler(BaseHTTPRequestHandler):
     """HTTP request handler for camera streaming."""
 
+    # Set TCP_NODELAY and buffer wfile so headers and body go out together
+    disable_nagle_algorithm = True
+    wbufsize = 65536
+
     def log_message(self, format, *args):
         # Reduce log spam
         pass
@@ -129,33 +168,42 @@ class CameraHandler(BaseHTTPRequestHandler):
         self.send_header('Cache-Control', 'no-cache, private')
         self.send_header('Pragma', 'no-cache')
         self.end_headers()
+        # Frames bypass wfile, so this is the only flush for the stream
+        self.wfile.flush()
 
+        viewer = output.add_viewer()
         try:
             while True:
-                with output.condition:
-                    # Wait for a new frame with timeout to prevent deadlock
-                    if not output.condition.wait(timeout=5.0):
-                        continue  # Timeout, try again
-                    frame = output.frame
+                # Wait for a new frame with timeout to prevent deadlock
+                try:
+                    frame = viewer.frames.get(timeout=5.0)
+                except queue.Empty:
+                    continue  # Timeout, try again
                 
-                if frame:
-                    self.wfile.write(b'--FRAME\r\n')
-                    self.wfile.write(b'Content-Type: image/jpeg\r\n')
-                    self.wfile.write(f'Content-Length: {len(frame)}\r\n\r\n'.encode())
-                    self.wfile.write(frame)
-                    self.wfile.write(b'\r\n')
-                    self.wfile.flush()
+                self.send_frame(frame)
         except (BrokenPipeError, ConnectionResetError, ConnectionAbortedError):
             # Client disconnected - this is normal
             pass
         except Exception as e:
             logger.debug(f"Stream ended: {e}")
+        finally:
+            output.remove_viewer(viewer)
+
+    def send_frame(self, frame):
+        """Send one multipart frame with a single vectored write."""
+        parts = [MJPEG_FRAME_PREFIX, str(len(frame)).encode(),
+                 MJPEG_HEADER_END, frame, MJPEG_FRAME_END]
+        sent = self.connection.sendmsg(parts)
+        if sent < sum(map(len, parts)):
+            # Partial send - rare on a blocking socket
+            self.connection.sendall(b''.join(parts)[sent:])
 
     def send_snapshot(self):
-        with output.condition:
-            output.condition.wait()
-            frame = output.frame
-        self.send_content(frame, 'image/jpeg')
+        _, frame = output.wait_for_frame(output.latest[0])
+        if frame:
+            self.send_content(frame, 'image/jpeg')
+        else:
+            self.send_error(500, 'No frame available')
 
     def send_status(self):
         self.send_content(b'{"status":"ok"}', 'application/json')
@@ -174,32 +222,31 @@ class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
     daemon_threads = True
 
 
-def get_ip_address():
-    """Get the IP address of this device, works with hotspot mode too."""
-    import netifaces
-    
+def get_interface_address(sock, iface):
+    """Get the IPv4 address of a network interface, or None."""
+    try:
+        import fcntl  # Unix only; callers fall back to another lookup
+        request = struct.pack('256s', iface.encode()[:15])
+        packed = fcntl.ioctl(sock.fileno(), SIOCGIFADDR, request)
+    except (ImportError, OSError):
+        return None
+    return socket.inet_ntoa(packed[20:24])
+
+
+@functools.lru_cache(maxsize=1)
+def lookup_ip_address(ttl_bucket):
+    """Resolve the device IP; ttl_bucket changes to expire the cache."""
     # Priority order: wlan0 (hotspot), eth0, then any other interface
     preferred_interfaces = ['wlan0', 'eth0', 'en0', 'wlan1']
     
     try:
-        interfaces = netifaces.interfaces()
-        
-        # First try preferred interfaces in order
-        for iface in preferred_interfaces:
-            if iface in interfaces:
-                addrs = netifaces.ifaddresses(iface)
-                if netifaces.AF_INET in addrs:
-                    ip = addrs[netifaces.AF_INET][0].get('addr')
-                    if ip and not ip.startswith('127.'):
-                        return ip
+        interfaces = [name for _, name in socket.if_nameindex()]
+        ordered = [i for i in preferred_interfaces if i in interfaces]
+        ordered += [i for i in interfaces if i not in ordered and i != 'lo']
         
-        # Fall back to any interface with a valid IP
-        for iface in interfaces:
-            if iface == 'lo':
-                continue
-            addrs = netifaces.ifaddresses(iface)
-            if netifaces.AF_INET in addrs:
-                ip = addrs[netifaces.AF_INET][0].get('addr')
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            for iface in ordered:
+                ip = get_interface_address(s, iface)
                 if ip and not ip.startswith('127.'):
                     return ip
     except Exception:
@@ -217,6 +264,11 @@ def get_ip_address():
         return "localhost"
 
 
+def get_ip_address():
+    """Get the IP address of this device, works with hotspot mode too."""
+    return lookup_ip_address(int(time.monotonic() // IP_CACHE_TTL))
+
+
 def main():
     global picam2
     logger.info("Starting Camera Server...")
@@ -224,16 +276,13 @@ def main():
     # Initialize Picamera2
     picam2 = Picamera2()
     
-    # Configure for still capture (works better for JPEG capture)
-    config = picam2.create_still_configuration(
-        main={"size": (FRAME_WIDTH, FRAME_HEIGHT)}
+    # Configure for video so frames go through the hardware JPEG encoder
+    config = picam2.create_video_configuration(
+        main={"size": (FRAME_WIDTH, FRAME_HEIGHT), "format": "YUV420"},
+        controls={"FrameRate": FRAME_RATE}
     )
     picam2.configure(config)
-    picam2.start()
-
-    # Start the background capture thread
-    capture_thread = threading.Thread(target=capture_loop, daemon=True)
-    capture_thread.start()
+    picam2.start_recording(MJPEGEncoder(bitrate=STREAM_BITRATE), FileOutput(output))
 
     ip_address = get_ip_address()
     
@@ -250,7 +299,7 @@ def main():
     except KeyboardInterrupt:
         logger.info("\nStopping...")
     finally:
-        picam2.stop()
+        picam2.stop_recording()
         picam2.close()
         logger.info("Server stopped.")
 